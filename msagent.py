@@ -3,16 +3,38 @@ import os
 import re
 import argparse
 import signal
+import functools
+import threading
+from collections import OrderedDict
 
-from PySide6.QtCore import *
-from PySide6.QtGui import *
-from PySide6.QtWidgets import *
-from PySide6.QtMultimedia import QSoundEffect, QAudioOutput
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from PySide6.QtCore import QMetaObject, QObject, QThread, QThreadPool, QTimer, QUrl, Qt, Signal, Slot
+from PySide6.QtGui import QColor, QImage, QPainter, QPixmap
+from PySide6.QtWidgets import QLabel
+from PySide6.QtMultimedia import QSoundEffect
+
+
+# One line of an ACD file: a block start, a block end or a property.
+# [^\S\n] is whitespace that never crosses into the next line.
+_ACD_RE = re.compile(
+    r"^[^\S\n]*(?:"
+    r"(?P<start>Define\w+)(?:[^\S\n]+(?P<arg>[^\n]*?))?"
+    r"|(?P<end>End\w+)"
+    r"|(?P<key>\w+)[^\S\n]*=[^\S\n]*(?P<val>[^\n]*?)"
+    r")[^\S\n]*$",
+    re.MULTILINE,
+)
 
 
 def _parseVal(value: str) -> object:
-    value = value.strip().strip('"')
-    if value.isdigit():
+    # _ACD_RE already trims surrounding whitespace
+    if value[:1] == '"' or value[-1:] == '"':
+        value = value.strip('"')
+    if value.isdecimal():
         return int(value)
     return value
 
@@ -31,19 +53,15 @@ def parseAcd(text: str) -> dict:
     data = {}
     stack = [("root", data)]
 
-    startBlockPattern = re.compile(r"^\s*(Define\w+)(?:\s+(.*))?$")
-    endBlockPattern = re.compile(r"^\s*(End\w+)\s*$")
-    propertyPattern = re.compile(r"^\s*(\w+)\s*=\s*(.*)$")
-
-    for line in text.splitlines():
-        line = line.strip()
-        if not line or line.startswith("//"):
-            continue
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
 
-        startMatch = startBlockPattern.match(line)
-        if startMatch:
-            blockType = startMatch.group(1).replace("Define", "")
-            arg = startMatch.group(2)
+    # Comments and blank lines simply never match
+    for match in _ACD_RE.finditer(text):
+        blockType = match["start"]
+        if blockType:
+            blockType = blockType.replace("Define", "")
+            arg = match["arg"]
             newBlock = {}
             if arg:
                 newBlock["id"] = _parseVal(arg)
@@ -51,21 +69,12 @@ def parseAcd(text: str) -> dict:
             parentName, parentObj = stack[-1]
             _addChild(parentObj, blockType, newBlock)
             stack.append((blockType, newBlock))
-            continue
-
-        endMatch = endBlockPattern.match(line)
-        if endMatch:
+        elif match["end"]:
             if len(stack) > 1:
                 stack.pop()
-            continue
-
-        propertyMatch = propertyPattern.match(line)
-        if propertyMatch:
-            key = propertyMatch.group(1)
-            val = _parseVal(propertyMatch.group(2))
+        else:
             _, currentObj = stack[-1]
-            currentObj[key] = val
-            continue
+            currentObj[match["key"]] = _parseVal(match["val"])
 
     return data
 
@@ -75,6 +84,11 @@ def loadAcd(acdPath: str) -> dict:
         raise FileNotFoundError(f"ACD file not found: {acdPath}")
     with open(acdPath, "r", encoding="ISO-8859-1", errors="replace") as f:
         data = parseAcd(f.read())
+    # Keys starting with "_" are reserved for derived data and never come
+    # from the file (ACD block names start with a letter). Code walking the
+    # parsed tree should skip them:
+    #   _animationIndex: animation name -> animation block, see getAnimationData
+    data["_animationIndex"] = _indexAnimations(data)
     return data
 
 
@@ -87,138 +101,348 @@ def _asList(data: dict, key: str) -> list:
     return [val]
 
 
-def listAnimations(acdData: dict) -> list[str]:
-    animations = []
+def _collectValues(roots: list, key: str) -> set:
+    values = set()
+    stack = list(roots)
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, dict):
+            val = obj.get(key)
+            if val:
+                values.add(val)
+            stack.extend(obj.values())
+        elif isinstance(obj, list):
+            stack.extend(obj)
+    return values
+
+
+def _indexAnimations(acdData: dict) -> dict:
+    index = {}
     for animation in _asList(acdData, "Animation"):
         name = animation.get("id")
         if name and isinstance(name, str):
-            animations.append(name)
-    return sorted(animations)
+            index.setdefault(name, animation)
+    return index
+
+
+def _getAnimationIndex(acdData: dict) -> dict:
+    index = acdData.get("_animationIndex")
+    if index is None:
+        index = _indexAnimations(acdData)
+    return index
+
+
+def listAnimations(acdData: dict) -> list[str]:
+    return sorted(_getAnimationIndex(acdData))
 
 
 def getAnimationData(acdData: dict, animationName: str) -> dict:
-    for animation in _asList(acdData, "Animation"):
-        if animation.get("id") == animationName:
-            return animation
-    return {}
+    return _getAnimationIndex(acdData).get(animationName, {})
+
+
+def _byteSize(image) -> int:
+    # Works for both QImage and QPixmap
+    return image.width() * image.height() * image.depth() // 8
+
+
+class _LRUImageCache:
+    """Maps keys to QImages or QPixmaps, evicting least recently used entries
+    once the total image size exceeds maxBytes."""
+
+    def __init__(self, maxBytes: int):
+        self.maxBytes = maxBytes
+        self.bytesUsed = 0
+        self._items = OrderedDict()
+
+    def __contains__(self, key) -> bool:
+        return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __getitem__(self, key):
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def __setitem__(self, key, image):
+        if key in self._items:
+            self.bytesUsed -= _byteSize(self._items.pop(key))
+        self._items[key] = image
+        self.bytesUsed += _byteSize(image)
+
+        # Always keep the newest entry, even if it alone exceeds the budget
+        while self.bytesUsed > self.maxBytes and len(self._items) > 1:
+            _, evicted = self._items.popitem(last=False)
+            self.bytesUsed -= _byteSize(evicted)
+
+    def get(self, key, default=None):
+        if key not in self._items:
+            return default
+        return self[key]
 
 
 class AnimationWorker(QObject):
-    imageReady = Signal(QImage)
+    imageReady = Signal(int)
     playSoundSignal = Signal(str)
     animationFinished = Signal()
 
     def __init__(self, acdPath: str, data: dict, animations: list[str], 
-                 speed: float, cycles: int):
+                 speed: float, cycles: int, maxCacheBytes: int = 64 * 1024 * 1024):
         super().__init__()
         self.acdPath = acdPath
         self.data = data
         self.animations = animations
         self.speed = speed
         self.cycles = cycles
-        self.defaultDuration = 10
         self._running = True
-        self._imageCache = {}
+        self._imageCache = _LRUImageCache(maxCacheBytes)
+        self._frameCache = _LRUImageCache(maxCacheBytes)
+        self._missingImages = set()
+
+        charData = data.get("Character", {})
+        if isinstance(charData, list): 
+            charData = charData[0]
+        self.defaultDuration = charData.get("DefaultFrameDuration", 10)
+
+        # Per-animation frame arrays: (keys, layers, sounds, durations).
+        # Keys are small ints, since signals cannot carry id() values.
+        self._timelines = {}
+        self._frameCount = 0
+        for animationName in animations:
+            if animationName not in self._timelines:
+                self._timelines[animationName] = self._buildTimeline(animationName)
+
+        # Frames emitted by key and not yet picked up by the GUI thread
+        self._pendingFrames = {}
+        self._pendingLock = threading.Lock()
+
+        # Playback position, advanced by _tick
+        self._loopCount = 0
+        self._animationPos = 0
+        self._timeline = ([], [], [], [])
+        self._frameIndex = 0
+        self._passHadFrames = False
+
+        # Child of the worker so it follows it into the animation thread
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._tick)
 
     def stop(self):
         self._running = False
 
+        # The timer lives in the animation thread and must be stopped there
+        thread = self.thread()
+        if thread == QThread.currentThread():
+            self._stopTimer()
+        elif thread.isRunning():
+            QMetaObject.invokeMethod(self, "_stopTimer", Qt.BlockingQueuedConnection)
+
+    @Slot()
+    def _stopTimer(self):
+        if self._timer.isActive():
+            self._timer.stop()
+            self.animationFinished.emit()
+
+    def takeFrame(self, key: int):
+        with self._pendingLock:
+            return self._pendingFrames.pop(key, None)
+
+    def _buildTimeline(self, animationName: str) -> tuple:
+        keys, layers, sounds, durations = [], [], [], []
+        for frame in _asList(getAnimationData(self.data, animationName), "Frame"):
+            keys.append(self._frameCount)
+            self._frameCount += 1
+            # Stored bottom-most first, the order they are painted in
+            layers.append(tuple(
+                image.get("Filename", "") for image in reversed(_asList(frame, "Image"))
+            ))
+            sounds.append(frame.get("SoundEffect", None))
+            rawDuration = frame.get("Duration", self.defaultDuration)
+            durations.append(max(10, int((rawDuration * 10) / self.speed)))
+        return keys, layers, sounds, durations
+
+    def _readImage(self, fname: str):
+        # One open/read per file; a missing or undecodable file gives None
+        path = os.path.join(os.path.dirname(self.acdPath), fname)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        # Try the suffix as a format hint first so Qt does not probe every plugin
+        suffix = os.path.splitext(fname)[1][1:].upper()
+        image = QImage.fromData(data, suffix or None)
+        if image.isNull() and suffix:
+            image = QImage.fromData(data)
+        if image.isNull():
+            return None
+        return self._applyTransparency(image)
+
+    def _loadImage(self, fname: str):
+        img = self._imageCache.get(fname)
+        if img is not None or fname in self._missingImages:
+            return img
+
+        img = self._readImage(fname)
+        if img is None:
+            self._missingImages.add(fname)
+            return None
+
+        self._imageCache[fname] = img
+        return img
+
     def _preloadImages(self):
-        baseDir = os.path.dirname(self.acdPath)
-        
-        def recurse_find_images(obj):
-            if isinstance(obj, dict):
-                if "Filename" in obj:
-                    fname = obj["Filename"]
-                    if fname not in self._imageCache:
-                        path = os.path.join(baseDir, fname)
-                        if os.path.isfile(path):
-                            self._imageCache[fname] = QImage(path)
-                for v in obj.values():
-                    recurse_find_images(v)
-            elif isinstance(obj, list):
-                for item in obj:
-                    recurse_find_images(item)
-
-        recurse_find_images(self.data)
+        # Only the requested animations, so a large character does not overrun the cache
+        filenames = {
+            fname
+            for _, layers, _, _ in self._timelines.values()
+            for frameLayers in layers
+            for fname in frameLayers
+            if fname
+        }
+
+        # Read and decode in parallel; the cache itself is only touched from this thread
+        decoded = {}
+
+        def decode(fname):
+            decoded[fname] = self._readImage(fname)
+
+        pool = QThreadPool()
+        for fname in filenames:
+            if fname not in self._imageCache and fname not in self._missingImages:
+                pool.start(functools.partial(decode, fname))
+        pool.waitForDone()
+
+        for fname, img in decoded.items():
+            if img is None:
+                self._missingImages.add(fname)
+            else:
+                self._imageCache[fname] = img
+
+    def _precomposeFrames(self):
+        for keys, layers, _, _ in self._timelines.values():
+            for key, frameLayers in zip(keys, layers):
+                self._getFrame(key, frameLayers)
+
+    def _getFrame(self, key: int, layers: tuple) -> QImage:
+        img = self._frameCache.get(key)
+        if img is None:
+            img = self._composeFrame(layers)
+            self._frameCache[key] = img
+        return img
 
     def _applyTransparency(self, image: QImage) -> QImage:
+        if image.isNull():
+            return image
+
+        # Images with real alpha need no color key, which would also destroy it
+        if image.hasAlphaChannel():
+            return image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+
+        if np is not None:
+            # Single pass over the pixel buffer; ARGB32 pixels are native-endian uint32
+            image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+            pixels = np.frombuffer(image.bits(), dtype=np.uint32)
+            pixels[pixels == 0xFFFF00FF] = 0
+            return image
+
         image = image.convertToFormat(QImage.Format_ARGB32)
         magenta = QColor(255, 0, 255).rgb()
         mask = image.createMaskFromColor(magenta, Qt.MaskOutColor)
         image.setAlphaChannel(mask)
-        return image
+        return image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
 
     def run(self):
         self._preloadImages()
-        
-        charData = self.data.get("Character", {})
-        if isinstance(charData, list): 
-            charData = charData[0]
-        self.defaultDuration = charData.get("DefaultFrameDuration", 10)
+        self._precomposeFrames()
+        self._timer.start(0)
+
+    def _nextFrame(self):
+        while True:
+            if self._frameIndex < len(self._timeline[0]):
+                self._frameIndex += 1
+                self._passHadFrames = True
+                return self._frameIndex - 1
+
+            if self._animationPos >= len(self.animations):
+                # A pass without any frames would repeat forever with cycles == -1
+                if not self._passHadFrames:
+                    return None
+                self._loopCount += 1
+                self._animationPos = 0
+                self._passHadFrames = False
+
+            if self._animationPos == 0 and self.cycles != -1 and self._loopCount >= self.cycles:
+                return None
+
+            self._timeline = self._timelines[self.animations[self._animationPos]]
+            self._frameIndex = 0
+            self._animationPos += 1
+
+    @Slot()
+    def _tick(self):
+        i = self._nextFrame() if self._running else None
+        if i is None:
+            self.animationFinished.emit()
+            return
 
-        loopCount = 0
-        while self._running:
-            if self.cycles != -1 and loopCount >= self.cycles:
-                break
-            
-            for animationName in self.animations:
-                if not self._running: break
-                self._playAnimation(animationName)
-            
-            loopCount += 1
+        keys, layers, sounds, durations = self._timeline
+        key = keys[i]
+        img = self._getFrame(key, layers[i])
+        if not img.isNull():
+            with self._pendingLock:
+                self._pendingFrames[key] = img
+            self.imageReady.emit(key)
 
-        self.animationFinished.emit()
+        if sounds[i]:
+            self.playSoundSignal.emit(sounds[i])
 
-    def _playAnimation(self, animationName):
-        animationData = getAnimationData(self.data, animationName)
-        if not animationData:
-            return
+        self._timer.start(durations[i])
 
-        frames = _asList(animationData, "Frame")
-        
-        for frame in frames:
-            if not self._running: return
+    def _composeFrame(self, filenames: tuple) -> QImage:
+        layers = []
+        for fname in filenames:
+            layerImg = self._loadImage(fname)
+            if layerImg is not None:
+                layers.append(layerImg)
 
-            img = self._composeFrame(frame)
-            if not img.isNull():
-                self.imageReady.emit(img)
+        if not layers:
+            return QImage()
 
-            soundEffect = frame.get("SoundEffect", None)
-            if soundEffect:
-                self.playSoundSignal.emit(soundEffect)
+        # Cached images are already premultiplied ARGB32, so a single layer
+        # can be shared as-is instead of painted into a new buffer
+        if len(layers) == 1:
+            return layers[0]
 
-            rawDuration = frame.get("Duration", self.defaultDuration)
-            msDuration = int((rawDuration * 10) / self.speed)
-            QThread.msleep(max(10, msDuration))
-
-    def _composeFrame(self, frame: dict) -> QImage:
-        baseImage = QImage()
-        images = _asList(frame, "Image")
-        images.reverse()
-
-        painter = QPainter()
-
-        for imageEntry in images:
-            imageName = imageEntry.get("Filename", "")
-            if imageName not in self._imageCache:
-                continue
-            
-            layerImg = self._imageCache[imageName]
-            layerImg = self._applyTransparency(layerImg)
-            
-            if baseImage.isNull():
-                baseImage = QImage(layerImg.size(), QImage.Format_ARGB32)
-                baseImage.fill(Qt.transparent)
-                painter.begin(baseImage)
-            
+        size = layers[0].size()
+        if np is not None and all(layerImg.size() == size for layerImg in layers):
+            return self._blendLayers(layers)
+
+        baseImage = QImage(size, QImage.Format_ARGB32_Premultiplied)
+        baseImage.fill(Qt.transparent)
+
+        painter = QPainter(baseImage)
+        for layerImg in layers:
             painter.drawImage(0, 0, layerImg)
+        painter.end()
 
-        if painter.isActive():
-            painter.end()
-        elif not baseImage.isNull() and images:
-             pass
+        return baseImage
 
+    def _blendLayers(self, layers: list) -> QImage:
+        # Premultiplied source-over, one vectorized pass per layer:
+        # dst = src + dst * (255 - srcAlpha) / 255, rounded like Qt's qt_div_255
+        alpha = 3 if sys.byteorder == "little" else 0
+        dst = np.frombuffer(layers[0].constBits(), dtype=np.uint8).reshape(-1, 4).astype(np.uint16)
+        for layerImg in layers[1:]:
+            src = np.frombuffer(layerImg.constBits(), dtype=np.uint8).reshape(-1, 4)
+            t = dst * (255 - src[:, alpha:alpha + 1].astype(np.uint16))
+            dst = src + ((t + (t >> 8) + 0x80) >> 8)
+
+        baseImage = QImage(layers[0].size(), QImage.Format_ARGB32_Premultiplied)
+        out = np.frombuffer(baseImage.bits(), dtype=np.uint8).reshape(-1, 4)
+        out[:] = dst
         return baseImage
 
 
@@ -226,7 +450,8 @@ class MSAgentWidget(QLabel):
     animationFinished = Signal()
 
     def __init__(self, parent=None, acdPath="", animations=None, 
-                 scale=1.0, volume=1.0, cycles=1, speed=1.0):
+                 scale=1.0, volume=1.0, cycles=1, speed=1.0,
+                 maxCacheBytes=64 * 1024 * 1024):
         super().__init__(parent)
         
         try:
@@ -235,15 +460,27 @@ class MSAgentWidget(QLabel):
             print(f"Error loading ACD: {e}")
             self.data = {}
 
+        for name in animations or []:
+            if not getAnimationData(self.data, name):
+                print(f"Animation not found: {name}")
+
         self.scale = scale
         self.volume = volume
         self.acdPath = acdPath
         
         # Cache for QSoundEffect objects
         self._soundEffects = {} 
+        roots = [getAnimationData(self.data, name) for name in animations or []]
+        for filename in _collectValues(roots, "SoundEffect"):
+            self._loadSound(filename)
+
+        self._finished = False
+
+        # Display-ready pixmaps keyed by (frame key, scale)
+        self._scaledCache = _LRUImageCache(maxCacheBytes)
 
         self._animationWorker = AnimationWorker(
-            acdPath, self.data, animations or [], speed, cycles
+            acdPath, self.data, animations or [], speed, cycles, maxCacheBytes
         )
 
         self._animationWorker.imageReady.connect(self.updateFrame)
@@ -258,22 +495,33 @@ class MSAgentWidget(QLabel):
         self._animationThread.start()
 
     def closeEvent(self, event):
-        self._animationWorker.stop()
+        # Once finished, the thread's event loop may already be gone and
+        # could no longer service stop()'s blocking call
+        if not self._finished:
+            self._animationWorker.stop()
         self._animationThread.quit()
         self._animationThread.wait()
         super().closeEvent(event)
 
-    @Slot(QImage)
-    def updateFrame(self, img: QImage):
-        pixmap = QPixmap.fromImage(img)
-        
-        if self.scale != 1.0:
-            pixmap = pixmap.scaled(
-                int(pixmap.width() * self.scale), 
-                int(pixmap.height() * self.scale), 
-                Qt.KeepAspectRatio,
-                Qt.SmoothTransformation
-            )
+    @Slot(int)
+    def updateFrame(self, frameKey: int):
+        img = self._animationWorker.takeFrame(frameKey)
+        key = (frameKey, self.scale)
+        pixmap = self._scaledCache.get(key)
+        if pixmap is None:
+            if img is None:
+                return
+            pixmap = QPixmap.fromImage(img)
+
+            if self.scale != 1.0:
+                pixmap = pixmap.scaled(
+                    int(pixmap.width() * self.scale), 
+                    int(pixmap.height() * self.scale), 
+                    Qt.KeepAspectRatio,
+                    Qt.SmoothTransformation
+                )
+
+            self._scaledCache[key] = pixmap
 
         self.setPixmap(pixmap)
 
@@ -281,13 +529,19 @@ class MSAgentWidget(QLabel):
     def playSound(self, filename: str):
         if filename in self._soundEffects:
             effect = self._soundEffects[filename]
-            if effect.status() == QSoundEffect.Ready:
+            # play() while still Loading is deferred until the sound is ready
+            if effect.status() not in (QSoundEffect.Error, QSoundEffect.Null):
                 effect.play()
             return
 
+        effect = self._loadSound(filename)
+        if effect is not None:
+            effect.play()
+
+    def _loadSound(self, filename: str):
         soundPath = os.path.join(os.path.dirname(self.acdPath), filename)
         if not os.path.isfile(soundPath):
-            return
+            return None
 
         effect = QSoundEffect(self)
         effect.setSource(QUrl.fromLocalFile(soundPath))
@@ -295,11 +549,11 @@ class MSAgentWidget(QLabel):
         
         # Keep reference so it doesn't get garbage collected
         self._soundEffects[filename] = effect
-        
-        effect.play()
+        return effect
 
     @Slot()
     def _onAnimationFinished(self):
+        self._finished = True
         self._animationThread.quit()
         self.animationFinished.emit()
 
@@ -326,6 +580,8 @@ def main():
             print(f" - {anim}")
         sys.exit(0)
 
+    from PySide6.QtWidgets import QApplication, QMainWindow
+
     os.environ["QT_LOGGING_RULES"] = "qt.multimedia.ffmpeg*=false"
     qapp = QApplication(sys.argv)
 